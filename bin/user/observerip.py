@@ -4,8 +4,11 @@
 """weewx driver for Ambient ObserverIP"""
 
 from __future__ import with_statement
+from contextlib import closing
 import time
+import httplib
 import io
+import math
 import socket
 import sys
 import syslog
@@ -62,11 +65,50 @@ def _norm(val):
     return 0 if val == 'Normal' else 1
 
 
+class WindStats(object):
+    """Peak gust with the direction it came from, and the vector mean wind
+    direction, accumulated one sample at a time over the interval between
+    full packets."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.gust = None
+        self.gustdir = None
+        self.xsum = 0.0
+        self.ysum = 0.0
+
+    def add(self, speed, gust, direction):
+        for val in (gust, speed):
+            if val is not None and (self.gust is None or val > self.gust):
+                self.gust = val
+                self.gustdir = direction
+        if speed is not None and direction is not None:
+            self.xsum += speed * math.sin(math.radians(direction))
+            self.ysum += speed * math.cos(math.radians(direction))
+
+    def vecdir(self):
+        if self.xsum == 0.0 and self.ysum == 0.0:
+            return None
+        vecdir = math.degrees(math.atan2(self.xsum, self.ysum)) % 360.0
+        return 0.0 if vecdir >= 360.0 else vecdir
+
+    def apply(self, packet):
+        if self.gust is not None:
+            packet['windGust'] = self.gust
+            packet['windGustDir'] = self.gustdir
+        vecdir = self.vecdir()
+        if vecdir is not None:
+            packet['windDirAvg'] = vecdir
+
+
 class ObserverIPStation():
     """Interface to communicate directly with ObserverIP"""
 
     UDP_PORT = 25122
     MESSAGE = "ASIXXISA\x00"
+    MAX_LINE = 512
 
     CALIBRATIONBOUND = {
         'RainGain': (to_float, 0.1, 5.0),
@@ -87,24 +129,51 @@ class ObserverIPStation():
         self.hostname = stn_dict.get('hostname', None)
         self.max_tries = int(stn_dict.get('max_tries', 5))
         self.retry_wait = int(stn_dict.get('retry_wait', 2))
+        self.timeout = float(stn_dict.get('timeout', 5))
         self.infopacket = None
+        self._sock = None
         #FIXME modify to allow using hostname to traverse routers
-        self.infopacket = self.infoprobe()
-        if not self.infopacket:
-            raise Exception('ObserverIP network probe failed')
+        try:
+            self.infopacket = self.infoprobe()
+            if not self.infopacket:
+                raise Exception('ObserverIP network probe failed')
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        self.close()
+
+    def close(self):
+        """release the probe socket"""
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def probesocket(self):
+        """return the UDP probe socket, creating it on first use so that
+        repeated probes (e.g. after reboot) reuse the same descriptor"""
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if self.hostname is None:
+                self._sock.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        return self._sock
 
     def infoprobe(self):
         udp_addr = self.hostname
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP socket
         if udp_addr is None:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
             udp_addr = "255.255.255.255"
+        sock = self.probesocket()
+        self.drainprobe(sock)
         for count in range(self.max_tries):
             try:
                 sock.sendto(self.MESSAGE, (udp_addr, self.UDP_PORT))
                 sock.settimeout(self.retry_wait)
-                recv_data, (addr, port) = sock.recvfrom(1024)
-                return recv_data
+                return self.probereply(sock)
             except socket.timeout:
                 logerr("socket timeout %d of %d" % (count+1, self.max_tries))
                 time.sleep(self.retry_wait)
@@ -115,6 +184,29 @@ class ObserverIPStation():
             logerr("probe failed after %d tries" % self.max_tries)
         return None
 
+    @staticmethod
+    def drainprobe(sock):
+        """discard replies to earlier probes that arrived after we stopped
+        waiting for them, so that a new probe only sees current replies"""
+        sock.setblocking(0)
+        try:
+            while True:
+                sock.recvfrom(1024)
+        except socket.error:
+            pass
+
+    def probereply(self, sock):
+        """wait for a reply from the station port, and from the station
+        itself when a hostname is configured"""
+        station = None
+        if self.hostname is not None:
+            station = socket.gethostbyname(self.hostname)
+        while True:
+            recv_data, (addr, port) = sock.recvfrom(1024)
+            if port == self.UDP_PORT and station in (None, addr):
+                return recv_data
+            logdbg("ignoring probe reply from %s:%d" % (addr, port))
+
     def packetstr(self, ind):
         es = self.infopacket.find('\x00', ind)
         return self.infopacket[ind:es]
@@ -176,16 +268,29 @@ class ObserverIPStation():
 
         for count in range(self.max_tries):
             try:
-                response = urllib2.urlopen(url)
+                response = urllib2.urlopen(url, timeout=self.timeout)
+                with closing(response):
+                    self.parse_form(response, dat, value)
                 break
-            except urllib2.URLError:
+            except (urllib2.URLError, httplib.HTTPException,
+                    socket.error), e:
+                if hasattr(e, 'close'):
+                    e.close()
+                dat.clear()
                 logerr('data retrieval failed attempt %d of %d: %s' %
-                       (count + 1, self.max_tries, ''))
+                       (count + 1, self.max_tries, e))
                 time.sleep(self.retry_wait)
         else:
             logerr('data retrieval failed after %d tries' % self.max_tries)
             return dat
 
+        for i in ('Cancel', 'Apply', 'corr_Default', 'rain_Default', 'reboot', 'restore'):
+            if i in dat:
+                del dat[i]
+        return dat
+
+    @staticmethod
+    def parse_form(response, dat, value):
         for line in response:
             try:
                 line.index('<input')
@@ -204,6 +309,8 @@ class ObserverIPStation():
                     name = line[es + 6:ee]
                     while True:
                         nextline = response.readline()
+                        if not nextline:
+                            break
                         sl = nextline.find('selected')
                         if sl != -1:
                             if value:
@@ -219,10 +326,18 @@ class ObserverIPStation():
                             break
                 except ValueError:
                     pass
-        for i in ('Cancel', 'Apply', 'corr_Default', 'rain_Default', 'reboot', 'restore'):
-            if i in dat:
-                del dat[i]
-        return dat
+
+    def postpage(self, page, param=None):
+        """request a page on the station, discarding the response"""
+        try:
+            response = urllib2.urlopen(
+                'http://%s/%s' % (self.ipaddr(), page), param,
+                timeout=self.timeout)
+        except urllib2.HTTPError, e:
+            e.close()
+            raise
+        with closing(response):
+            pass
 
     @staticmethod
     def dict_to_param(d):
@@ -249,10 +364,10 @@ class ObserverIPStation():
         return self.page_to_dict(
             'http://%s/bscsetting.htm' % self.ipaddr(), not readable)
 
-    def setnetworksettings(self):
-        response = urllib2.urlopen(
-            "http://%s/bscsetting.htm" % self.ipaddr(),
-            self.dict_to_param(calibdata) + "&Apply=Apply")
+    def setnetworksettings(self, settings):
+        self.postpage('bscsetting.htm',
+                      self.dict_to_param(settings) + "&Apply=Apply")
+
     def setnetworkdefault(self):
         #print 'Not implemented'
         pass
@@ -271,9 +386,8 @@ class ObserverIPStation():
 
     def setidpasswd(self, wuid, passwd):
         """set wunderground id and passwd"""
-        response = urllib2.urlopen(
-            "http://%s/weather.htm" % self.ipaddr(),
-            "stationID=%s&stationPW=%s&Apply=Apply" % (wuid, passwd))
+        self.postpage('weather.htm',
+                      "stationID=%s&stationPW=%s&Apply=Apply" % (wuid, passwd))
 
     def getstationsettings(self, readable=False):
         return self.page_to_dict(
@@ -282,28 +396,62 @@ class ObserverIPStation():
     def setstationsettings(self, settings):
         if 'WRFreq' in settings:
             del settings['WRFreq']
-        response = urllib2.urlopen(
-            "http://%s/station.htm" % self.ipaddr(),
-            self.dict_to_param(settings) + "&Apply=Apply")
+        self.postpage('station.htm',
+                      self.dict_to_param(settings) + "&Apply=Apply")
 
     def get_data(self):
         return self.page_to_dict('http://%s/livedata.htm' % self.ipaddr())
 
+    def get_fields(self, names, timeout):
+        """minimal parse of the live data page: return only the named input
+        fields, reading lines into a bounded buffer and stopping as soon as
+        every name has been seen.  Make a single attempt, since the caller
+        will poll again shortly; any failure returns an empty dict."""
+        try:
+            response = urllib2.urlopen(
+                'http://%s/livedata.htm' % self.ipaddr(), timeout=timeout)
+            with closing(response):
+                return self.parse_fields(response, names)
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            if hasattr(e, 'close'):
+                e.close()
+            logdbg('field retrieval failed: %s' % e)
+            return dict()
+
+    def parse_fields(self, response, names):
+        dat = dict()
+        while len(dat) < len(names):
+            line = response.readline(self.MAX_LINE)
+            if not line:
+                break
+            es = line.find('name="')
+            if es == -1 or line.find('<input') == -1:
+                continue
+            ee = line.find('"', es + 6)
+            name = line[es + 6:ee]
+            if name not in names:
+                continue
+            es = line.find('value="', ee)
+            if es == -1:
+                continue
+            ee = line.find('"', es + 7)
+            if ee != -1:
+                dat[name] = line[es + 7:ee]
+        return dat
+
     def getcalibration(self):
         return self.page_to_dict('http://%s/correction.htm' % self.ipaddr())
 
     def setcalibration(self, calibdata):
         self.boundcheck(self.CALIBRATIONBOUND ,calibdata)
         try:
-            response = urllib2.urlopen(
-                "http://%s/correction.htm" % self.ipaddr(),
-                self.dict_to_param(calibdata) + "&Apply=Apply")
-            pass
+            self.postpage('correction.htm',
+                          self.dict_to_param(calibdata) + "&Apply=Apply")
         except urllib2.URLError:
             pass
 
     def setcalibrationdefault(self):
-        response = urllib2.urlopen('http://%s/msgcoredef.htm' % self.ipaddr())
+        self.postpage('msgcoredef.htm')
 
 # =============================================================================
 
@@ -367,6 +515,8 @@ class ObserverIPDriver(weewx.drivers.AbstractDevice):
         }
     }
 
+    RAPID_OBS = ('windSpeed', 'windGust', 'windDir')
+
     def __init__(self, **stn_dict):
         loginf("version is %s" % DRIVER_VERSION)
 
@@ -379,9 +529,32 @@ class ObserverIPDriver(weewx.drivers.AbstractDevice):
         self.check_calibration = to_bool(
             stn_dict.get('check_calibration', False))
         self.set_calibration = to_bool(stn_dict.get('set_calibration', False))
+        self.rapid_wind = to_bool(stn_dict.get('rapid_wind', False))
+        self.rapid_wind_interval = min(max(
+            float(stn_dict.get('rapid_wind_interval', 2)), 1.0), 4.0)
         self.last_rain_total = None
         self.last_datetime = 0
+        self.last_wind = None
+        self.last_wind_datetime = 0
+        self.wind_stats = WindStats()
+        self._station = None
+
+        if self.rapid_wind and self.mode != 'direct':
+            loginf("rapid wind is only available in direct mode")
+            self.rapid_wind = False
 
+        try:
+            self._setup_station(stn_dict)
+        except:
+            self.closePort()
+            raise
+
+        loginf("polling interval is %s" % self.poll_interval)
+        if self.rapid_wind:
+            self.wind_names = [self.map[obs][0] for obs in self.RAPID_OBS]
+            loginf("rapid wind interval is %s" % self.rapid_wind_interval)
+
+    def _setup_station(self, stn_dict):
         if self.mode == 'direct':
             self._station = ObserverIPStation(**stn_dict)
             if self.chkunits(ObserverIPDriver.EXPECTED_UNITS):
@@ -409,15 +582,21 @@ class ObserverIPDriver(weewx.drivers.AbstractDevice):
                         raise Exception("Setting calibration unsuccessful")
                 else:
                     raise Exception("calibration error")
-                
-        loginf("polling interval is %s" % self.poll_interval)
 
     @property
     def hardware_name(self):
         return "ObserverIP"
 
+    def closePort(self):
+        if self._station is not None:
+            self._station.close()
+            self._station = None
+
     def genLoopPackets(self):
-        while True:    
+        if self.rapid_wind:
+            for packet in self.gen_rapid_packets():
+                yield packet
+        while True:
             if self.mode == 'direct':
                 data = self.get_data_direct()
             else:
@@ -436,6 +615,51 @@ class ObserverIPDriver(weewx.drivers.AbstractDevice):
             else:
                 time.sleep(self.dup_interval)
 
+    def gen_rapid_packets(self):
+        """Emit a full packet every poll_interval.  In between, poll only the
+        wind fields every rapid_wind_interval and emit a partial packet when
+        any of them changes."""
+        next_full = 0
+        while True:
+            now = time.time()
+            if now >= next_full:
+                packet = self.parse_page(self.get_data_direct())
+                if packet:
+                    self.last_wind = tuple(
+                        packet.get(obs) for obs in self.RAPID_OBS)
+                    self.wind_stats.add(*self.last_wind)
+                    self.wind_stats.apply(packet)
+                    self.wind_stats.reset()
+                    next_full = now + self.poll_interval
+                    yield packet
+            else:
+                packet = self.get_wind_packet()
+                if packet:
+                    yield packet
+            time.sleep(self.rapid_wind_interval)
+
+    def get_wind_packet(self):
+        data = self._station.get_fields(self.wind_names,
+                                        self.rapid_wind_interval / 2)
+        if not data:
+            return None
+        wind = tuple(self.map[obs][1](data[self.map[obs][0]])
+                     if self.map[obs][0] in data else None
+                     for obs in self.RAPID_OBS)
+        self.wind_stats.add(*wind)
+        if wind == self.last_wind:
+            return None
+        dateTime = int(time.time() + 0.5)
+        if dateTime <= max(self.last_datetime, self.last_wind_datetime):
+            return None
+        self.last_wind = wind
+        self.last_wind_datetime = dateTime
+        packet = {'dateTime': dateTime, 'usUnits': weewx.US}
+        for obs, val in zip(self.RAPID_OBS, wind):
+            if val is not None:
+                packet[obs] = val
+        return packet
+
     def get_data_from_file(self):
         data = dict()
         for count in range(self.max_tries):
@@ -540,6 +764,15 @@ class ObserverIPConfEditor(weewx.drivers.AbstractConfEditor):
     # faster than every 16 seconds.
     poll_interval = 16
 
+    # The station updates wind much faster than the other sensors.  In direct
+    # mode, enable rapid_wind to poll only the wind fields every
+    # rapid_wind_interval seconds (1 to 4) between full packets.  Partial
+    # packets with windSpeed, windGust and windDir are emitted when the wind
+    # changes.  Full packets report the peak gust seen since the last one as
+    # windGust and windGustDir, and the vector mean direction as windDirAvg.
+    #rapid_wind = false
+    #rapid_wind_interval = 2
+
     # Specify the hostname or IP address of the ObserverIP.  If not specified,
     # the driver will find the station by broadcasting on the local network.
     #hostname = 192.168.0.10
@@ -555,6 +788,9 @@ class ObserverIPConfEditor(weewx.drivers.AbstractConfEditor):
     # How often to wait after a failed network connection, in seconds
     #retry_wait = 2
 
+    # How long to wait for the station to answer a request, in seconds
+    #timeout = 5
+
     # Verify that the station calibration is as expected
     check_calibration = true
 
@@ -601,8 +837,10 @@ class ObserverIPConfigurator(weewx.drivers.AbstractConfigurator):
 
     def do_options(self, options, parser, config_dict, prompt):
         driver_dict = config_dict['ObserverIP']
-        station = ObserverIPStation(**driver_dict)
+        with ObserverIPStation(**driver_dict) as station:
+            self.do_station(station, options)
 
+    def do_station(self, station, options):
         if options.findobserver:
             sys.stdout.write("http://%s\n" % station.ipaddr())
             try:
@@ -637,5 +875,8 @@ if __name__ == "__main__":
 
     mode = 'direct' if options.xferfile is None else 'indirect'
     station = ObserverIPDriver(mode=mode, xferfile=options.xferfile)
-    for p in station.genLoopPackets():
-        print weeutil.weeutil.timestamp_to_string(p['dateTime']), p
+    try:
+        for p in station.genLoopPackets():
+            print weeutil.weeutil.timestamp_to_string(p['dateTime']), p
+    finally:
+        station.closePort()
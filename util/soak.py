@@ -0,0 +1,504 @@
+#!/usr/bin/python
+# Copyright 2017 Matthew Wall
+"""Soak test for the ObserverIP driver.
+
+Runs a fake ObserverIP (UDP discovery responder plus the livedata, station
+and correction pages) in a child process, then drives the driver in direct
+mode for a large number of polls.  Every so often the fake station answers
+a request with an error, truncates a page, closes or resets the connection
+without answering, or stalls for longer than the driver timeout.  It also
+ignores some discovery probes and answers others only after the driver has
+given up waiting.  The driver loop must keep yielding packets through all
+of this.  The wind on the fake station changes with every request.
+
+Now and then the driver is asked to re-probe the station, as it does after
+a reboot.  The fake station advertises a new address each time, and the
+driver must report that address, not one from a stale reply.
+
+With --rapid the driver runs in rapid wind mode.  Each partial packet must
+hold only dateTime, usUnits and the wind fields, and each full packet must
+report the peak gust, its direction and the vector mean direction of the
+wind samples the driver read since the previous full packet.
+
+The driver's own genLoopPackets is run, with the clock inside the driver
+replaced so that sleeps return at once while timestamps keep advancing.
+Every http response and udp socket the driver opens is remembered, and the
+test fails as soon as a packet is yielded with a response still open or
+with more than the one probe socket open.  Without this, leaks would not
+show up at all, since CPython closes a dropped response or socket as soon as
+its last reference goes away.
+
+Resource usage of the driver process is also sampled as it runs.  After
+warmup the resident set size, number of open file descriptors and number of
+threads must stay flat.  Net growth in gc-tracked objects and RSS per poll is
+reported.
+
+This is Linux only, since it reads /proc/self.  To run it:
+
+  PYTHONPATH=/home/weewx/bin python util/soak.py --polls=1000000
+"""
+
+from __future__ import with_statement
+import BaseHTTPServer
+import SocketServer
+import gc
+import math
+import multiprocessing
+import optparse
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import urllib2
+
+import user.observerip
+from user.observerip import ObserverIPDriver, ObserverIPStation
+
+VERSION = 'wh2600USA_v2.2.0'
+
+# the driver is run with retry_wait = 1 and timeout = 1, and rapid wind
+# requests time out after half of rapid_wind_interval
+STALL = 2.0
+LATE = 1.5
+
+LIVEDATA = {
+    'inTemp': '72.3',
+    'inHumi': '40',
+    'AbsPress': '29.91',
+    'outTemp': '55.6',
+    'outHumi': '62',
+    'windir': '225',
+    'avgwind': '3.4',
+    'gustspeed': '5.8',
+    'solarrad': '120.5',
+    'uvi': '2',
+    'rainofyearly': '10.21',
+    'inBattSta': 'Normal',
+    'outBattSta1': 'Normal'}
+
+STATION = {
+    'unit_Wind': 'mph',
+    'u_Rainfall': 'in',
+    'unit_Pressure': 'inhg',
+    'u_Temperature': 'degF',
+    'unit_Solar': 'w/m2'}
+
+
+def station_addr(generation):
+    """the address the fake station advertises after generation re-probes"""
+    return [10, (generation >> 16) & 255, (generation >> 8) & 255,
+            generation & 255]
+
+
+def infopacket(generation):
+    """build a discovery reply.  The driver is pointed at the fake station on
+    localhost separately, so the advertised address is only checked."""
+    pkt = bytearray(0x73 + len(VERSION) + 1)
+    pkt[0x22:0x26] = bytearray(station_addr(generation))
+    pkt[0x73:0x73 + len(VERSION)] = VERSION
+    return str(pkt)
+
+
+def input_page(data):
+    lines = ['<html><body><form>']
+    for name in data:
+        lines.append('<input name="%s" value="%s">' % (name, data[name]))
+    lines.append('<input name="Apply" value="Apply">')
+    lines.append('</form></body></html>')
+    return '\n'.join(lines) + '\n'
+
+
+def wind(n):
+    """wind readings that differ from one request to the next"""
+    speed = (n % 37) / 2.0
+    return {'avgwind': '%.1f' % speed,
+            'gustspeed': '%.1f' % (speed + n % 5),
+            'windir': str(n * 47 % 360)}
+
+
+def select_page(data):
+    lines = ['<html><body><form>']
+    for name in data:
+        lines.append('<select name="%s">' % name)
+        lines.append('<option value="0">x</option>')
+        lines.append('<option value="1" selected>%s</option>' % data[name])
+        lines.append('</select>')
+    lines.append('</form></body></html>')
+    return '\n'.join(lines) + '\n'
+
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    PAGES = {
+        '/livedata.htm': input_page(LIVEDATA),
+        '/station.htm': select_page(STATION),
+        '/correction.htm': input_page({})}
+
+    def do_GET(self):
+        self.server.requests += 1
+        page = self.PAGES.get(self.path)
+        if self.path == '/livedata.htm':
+            data = dict(LIVEDATA)
+            data.update(wind(self.server.requests))
+            page = input_page(data)
+        if page is None:
+            self.send_error(404)
+            return
+        fail_every = self.server.fail_every
+        phase = self.server.requests % fail_every if fail_every else None
+        if phase == 0:
+            self.send_error(500)
+            return
+        elif phase == fail_every // 2:
+            page = page[:len(page) // 3]
+        elif phase == fail_every // 4:
+            # close the connection without answering
+            return
+        elif phase == 3 * fail_every // 4:
+            # reset the connection without answering
+            self.connection.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.connection.close()
+            return
+        elif phase == fail_every // 8:
+            time.sleep(STALL)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # writing to a connection the driver gave up on is expected
+        pass
+
+
+def udp_responder(sock, generation, drop_every, late_every):
+    probes = 0
+    while True:
+        data, addr = sock.recvfrom(1024)
+        if data != ObserverIPStation.MESSAGE:
+            continue
+        probes += 1
+        reply = infopacket(generation.value)
+        if drop_every and probes % drop_every == 0:
+            continue
+        if late_every and probes % late_every == 0:
+            timer = threading.Timer(LATE, sock.sendto, (reply, addr))
+            timer.daemon = True
+            timer.start()
+            continue
+        sock.sendto(reply, addr)
+
+
+def fake_station(http_sock, udp_sock, generation, options):
+    """run in a child process so its threads and memory are not measured"""
+    server = FakeServer(
+        http_sock.getsockname(), FakeHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = http_sock
+    server.requests = 0
+    server.fail_every = options.fail_every
+    t = threading.Thread(
+        target=udp_responder,
+        args=(udp_sock, generation, options.drop_every, options.late_every))
+    t.daemon = True
+    t.start()
+    server.serve_forever()
+
+
+class FakeClock(object):
+    """stands in for the time module inside the driver"""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+
+def is_open(sock):
+    try:
+        sock.fileno()
+        return True
+    except socket.error:
+        return False
+
+
+class OpenTracker(object):
+    """remember every http response, including error responses, and every
+    udp socket that gets opened"""
+
+    def __init__(self):
+        self.responses = []
+        self.sockets = []
+
+    def install(self):
+        real_urlopen = urllib2.urlopen
+        real_socket = socket.socket
+
+        def urlopen(*args, **kwargs):
+            try:
+                response = real_urlopen(*args, **kwargs)
+            except urllib2.HTTPError, e:
+                self.responses.append(e)
+                raise
+            self.responses.append(response)
+            return response
+
+        def tracked_socket(family=socket.AF_INET, type=socket.SOCK_STREAM,
+                           proto=0):
+            sock = real_socket(family, type, proto)
+            if type == socket.SOCK_DGRAM:
+                self.sockets.append(sock)
+            return sock
+
+        urllib2.urlopen = urlopen
+        socket.socket = tracked_socket
+
+    def still_open(self):
+        """return the number of responses and udp sockets not yet closed"""
+        self.responses = [r for r in self.responses if r.fp is not None]
+        self.sockets = [s for s in self.sockets if is_open(s)]
+        return len(self.responses), len(self.sockets)
+
+
+class RapidChecker(object):
+    """check rapid wind packets against the raw wind samples the driver read
+    from the station since the last full packet"""
+
+    PARTIAL = set(['dateTime', 'usUnits', 'windSpeed', 'windGust', 'windDir'])
+
+    def __init__(self, driver):
+        self.map = driver.map
+        self.samples = []
+        self.full = False
+        station = driver._station
+        get_data = station.get_data
+        get_fields = station.get_fields
+
+        def full_poll():
+            data = get_data()
+            self.full = True
+            self.add(data)
+            return data
+
+        def rapid_poll(*args, **kwargs):
+            data = get_fields(*args, **kwargs)
+            self.full = False
+            if data:
+                self.add(data)
+            return data
+
+        station.get_data = full_poll
+        station.get_fields = rapid_poll
+
+    def add(self, data):
+        sample = []
+        for obs in ('windSpeed', 'windGust', 'windDir'):
+            name, func = self.map[obs]
+            sample.append(func(data[name]) if name in data else None)
+        self.samples.append(sample)
+
+    def expected(self):
+        peak = peakdir = None
+        x = y = 0.0
+        for speed, gust, direction in self.samples:
+            for val in (gust, speed):
+                if val is not None and (peak is None or val > peak):
+                    peak = val
+                    peakdir = direction
+            if speed is not None and direction is not None:
+                x += speed * math.sin(math.radians(direction))
+                y += speed * math.cos(math.radians(direction))
+        vecdir = None
+        if x != 0.0 or y != 0.0:
+            vecdir = math.degrees(math.atan2(x, y)) % 360.0
+        return peak, peakdir, vecdir
+
+    def check(self, packet):
+        """return a description of what is wrong with packet, if anything"""
+        if not self.full:
+            if not set(packet) <= self.PARTIAL:
+                return 'partial packet has %s' % sorted(packet)
+            if 'dateTime' not in packet or 'usUnits' not in packet:
+                return 'partial packet lacks dateTime or usUnits'
+            return None
+        peak, peakdir, vecdir = self.expected()
+        self.samples = []
+        if packet.get('windGust') != peak or \
+                packet.get('windGustDir') != peakdir:
+            return 'full packet gust %s from %s, expected %s from %s' % (
+                packet.get('windGust'), packet.get('windGustDir'),
+                peak, peakdir)
+        avg = packet.get('windDirAvg')
+        if (avg is None) != (vecdir is None) or (
+                vecdir is not None and
+                abs((avg - vecdir + 180.0) % 360.0 - 180.0) > 1e-6):
+            return 'full packet mean direction %s, expected %s' % (
+                avg, vecdir)
+        return None
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def sample(polls):
+    gc.collect()
+    return {'polls': polls,
+            'rss': rss(),
+            'fds': len(os.listdir('/proc/self/fd')),
+            'threads': threading.active_count(),
+            'objects': len(gc.get_objects())}
+
+
+def report(s):
+    print '%10d polls  rss=%dk  fds=%d  threads=%d  objects=%d' % (
+        s['polls'], s['rss'] // 1024, s['fds'], s['threads'], s['objects'])
+    sys.stdout.flush()
+
+
+def soak(options):
+    http_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    http_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    http_sock.bind(('127.0.0.1', 0))
+    http_sock.listen(16)
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_sock.bind(('127.0.0.1', 0))
+    http_port = http_sock.getsockname()[1]
+    udp_port = udp_sock.getsockname()[1]
+
+    generation = multiprocessing.Value('i', 0)
+    child = multiprocessing.Process(
+        target=fake_station,
+        args=(http_sock, udp_sock, generation, options))
+    child.daemon = True
+    child.start()
+    http_sock.close()
+    udp_sock.close()
+
+    # the real station listens on fixed ports, the fake one cannot
+    real_ipaddr = ObserverIPStation.ipaddr
+    ObserverIPStation.UDP_PORT = udp_port
+    ObserverIPStation.ipaddr = lambda self: '127.0.0.1:%d' % http_port
+    user.observerip.time = FakeClock()
+    tracker = OpenTracker()
+    tracker.install()
+
+    failed = []
+    samples = []
+    warmup = max(1, options.polls // 10)
+    driver = ObserverIPDriver(mode='direct', xferfile='', hostname='127.0.0.1',
+                              poll_interval=16, dup_interval=2,
+                              max_tries=3, retry_wait=1, timeout=1,
+                              rapid_wind=options.rapid, rapid_wind_interval=1)
+    checker = RapidChecker(driver) if options.rapid else None
+    try:
+        packets = driver.genLoopPackets()
+        for n in range(1, options.polls + 1):
+            try:
+                packet = packets.next()
+            except Exception, e:
+                failed.append('genLoopPackets raised %r at poll %d' % (e, n))
+                break
+            if checker is not None:
+                error = checker.check(packet)
+                if error:
+                    failed.append('%s at poll %d' % (error, n))
+                    break
+            responses, sockets = tracker.still_open()
+            if responses or sockets > 1:
+                failed.append('%d responses and %d udp sockets open at poll %d'
+                              % (responses, sockets, n))
+                break
+            if options.probe_every and n % options.probe_every == 0:
+                generation.value += 1
+                driver._station.reboot()
+                expected = '%d.%d.%d.%d' % tuple(
+                    station_addr(generation.value))
+                if driver._station.infopacket is None:
+                    failed.append('station not found at poll %d' % n)
+                    break
+                found = real_ipaddr(driver._station)
+                if found != expected:
+                    failed.append('station address %s, expected %s at poll %d'
+                                  % (found, expected, n))
+                    break
+            if n == warmup or n % options.sample_every == 0 \
+                    or n == options.polls:
+                s = sample(n)
+                report(s)
+                if n >= warmup:
+                    samples.append(s)
+    finally:
+        driver.closePort()
+        child.terminate()
+        child.join()
+
+    responses, sockets = tracker.still_open()
+    if responses or sockets:
+        failed.append('%d responses and %d udp sockets open after closePort'
+                      % (responses, sockets))
+    if not samples:
+        print 'FAIL: %s' % '; '.join(failed)
+        return 1
+    first, last = samples[0], samples[-1]
+    polls = last['polls'] - first['polls']
+    if last['rss'] - first['rss'] > options.rss_slack * 1024:
+        failed.append('rss grew by %dk' %
+                      ((last['rss'] - first['rss']) // 1024))
+    if last['fds'] != first['fds']:
+        failed.append('fds went from %d to %d' % (first['fds'], last['fds']))
+    if last['threads'] != first['threads']:
+        failed.append('threads went from %d to %d' %
+                      (first['threads'], last['threads']))
+    if polls:
+        print 'net growth per poll: %.4f objects, %.2f bytes rss' % (
+            float(last['objects'] - first['objects']) / polls,
+            float(last['rss'] - first['rss']) / polls)
+    if failed:
+        print 'FAIL: %s' % '; '.join(failed)
+        return 1
+    print 'PASS'
+    return 0
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--polls', type='int', default=1000000,
+                      help='number of polls to make')
+    parser.add_option('--sample-every', dest='sample_every', type='int',
+                      default=50000, help='polls between resource samples')
+    parser.add_option('--fail-every', dest='fail_every', type='int',
+                      default=1000,
+                      help='fail, truncate, drop, reset or stall one in this '
+                      'many http requests, in turn')
+    parser.add_option('--drop-every', dest='drop_every', type='int',
+                      default=5, help='ignore one in this many udp probes')
+    parser.add_option('--late-every', dest='late_every', type='int',
+                      default=3, help='answer one in this many udp probes '
+                      'after the driver stops waiting')
+    parser.add_option('--probe-every', dest='probe_every', type='int',
+                      default=10000, help='polls between station re-probes')
+    parser.add_option('--rapid', action='store_true', default=False,
+                      help='run the driver in rapid wind mode')
+    parser.add_option('--rss-slack', dest='rss_slack', type='int',
+                      default=512, help='allowed rss growth in kB')
+    (options, args) = parser.parse_args()
+    sys.exit(soak(options))